@@ -1,18 +1,110 @@
 import streamlit as st
 import json
+import orjson
 import pymupdf as fitz  # PyMuPDF
-from openai import OpenAI
+import openai
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+import httpx
+import asyncio
+import threading
 import time
-import tempfile
 import io
 import hashlib
-import os
 import re
 
+# -------------------------------
+# STRUCTURED OUTPUT FORMATS
+# -------------------------------
+def _json_schema_format(name, key, item_properties):
+    """
+    Strict structured-output response_format for {key: [item, ...]}.
+    """
+    item_schema = {
+        "type": "object",
+        "properties": item_properties,
+        "required": list(item_properties),
+        "additionalProperties": False
+    }
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {key: {"type": "array", "items": item_schema}},
+                "required": [key],
+                "additionalProperties": False
+            }
+        }
+    }
+
+QUESTION_SET_FORMAT = _json_schema_format("qset", "questions", {
+    "topic": {"type": "string"},
+    "question": {"type": "string"},
+    "answer_key": {"type": "string"}
+})
+
+GRADING_FORMAT = _json_schema_format("grades", "results", {
+    "score": {"type": "integer"},
+    "feedback": {"type": "string"},
+    "model_answer": {"type": "string"}
+})
+
 # -------------------------------
 # INITIALIZATION
 # -------------------------------
-client = OpenAI()
+@st.cache_resource
+def get_openai_client():
+    """
+    Shared OpenAI client, so every rerun and session reuses one connection pool.
+    """
+    return OpenAI(
+        max_retries=0,
+        http_client=DefaultHttpxClient(
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16)
+        )
+    )
+
+client = get_openai_client()
+
+def _is_transient(exc):
+    """
+    Rate limits, timeouts and 5xx are worth retrying; an exhausted quota is not.
+    """
+    if isinstance(exc, openai.RateLimitError):
+        return getattr(exc, "code", None) != "insufficient_quota"
+    return isinstance(exc, (openai.APIConnectionError, openai.InternalServerError))
+
+
+# Retry transient API failures with jittered backoff. Clients are built with
+# max_retries=0 so this is the only retry layer.
+_retry_transient = retry(
+    wait=wait_random_exponential(min=1, max=20),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception(_is_transient),
+    reraise=True
+)
+
+
+@_retry_transient
+def _chat(**kwargs):
+    return client.chat.completions.create(**kwargs)
+
+
+@_retry_transient
+async def _achat(async_client, **kwargs):
+    return await async_client.chat.completions.create(**kwargs)
+
+
+@_retry_transient
+def _whisper(audio_bytes):
+    # A fresh buffer per attempt, since the SDK consumes it on upload
+    return client.audio.transcriptions.create(
+        model="whisper-1",
+        file=("audio.wav", io.BytesIO(audio_bytes), "audio/wav")
+    )
 
 st.set_page_config(
     page_title="📘 Residency and Fellowship Board Exam Short Answer Question Generator",
@@ -55,6 +147,15 @@ if "current_set_id" not in st.session_state:
 if "generate_now" not in st.session_state:
     st.session_state["generate_now"] = False
 
+if "used_topics_set" not in st.session_state:
+    st.session_state["used_topics_set"] = set()  # topics across all_question_sets
+
+if "generation_nonce" not in st.session_state:
+    st.session_state["generation_nonce"] = 0  # bump to bypass the generation cache
+
+if "transcription_notices" not in st.session_state:
+    st.session_state["transcription_notices"] = {}
+
 
 # -------------------------------
 # PDF UPLOAD
@@ -62,21 +163,31 @@ if "generate_now" not in st.session_state:
 uploaded_file = st.file_uploader("📄 Upload a PDF file", type=["pdf"])
 
 def extract_text_from_pdf(pdf_bytes):
-    text = ""
+    # Kept serial on purpose: PyMuPDF holds the GIL during get_text and is not
+    # thread-safe, so a thread pool adds overhead and crash risk, not speed.
     with fitz.open(stream=io.BytesIO(pdf_bytes), filetype="pdf") as pdf_doc:
-        for page in pdf_doc:
-            text += page.get_text("text")
-    return text
+        return "".join(page.get_text("text", sort=False) for page in pdf_doc)
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _extract_text_cached(pdf_hash, _pdf_bytes):
+    """
+    Cached PDF extraction keyed on the SHA-256 of the file contents.
+    The leading underscore keeps Streamlit from re-hashing the raw bytes.
+    """
+    return extract_text_from_pdf(_pdf_bytes)
 
 if uploaded_file:
+    pdf_bytes = uploaded_file.getvalue()  # ✅ NOT .read()
+    pdf_hash = hashlib.sha256(pdf_bytes).hexdigest()
+
     if (
         "pdf_text" not in st.session_state
-        or st.session_state.get("uploaded_file_name") != uploaded_file.name
+        or st.session_state.get("pdf_hash") != pdf_hash
     ):
-        pdf_bytes = uploaded_file.getvalue()  # ✅ NOT .read()
-        pdf_text = extract_text_from_pdf(pdf_bytes)
+        pdf_text = _extract_text_cached(pdf_hash, pdf_bytes)
 
         st.session_state["pdf_text"] = pdf_text
+        st.session_state["pdf_hash"] = pdf_hash
         st.session_state["uploaded_file_name"] = uploaded_file.name
 
         st.success("✅ PDF uploaded successfully!")
@@ -89,86 +200,182 @@ if uploaded_file and not pdf_text:
     st.warning("PDF uploaded, but no text was extracted.")
 
 # -------------------------------
-# Question Topic Extraction
+# Question Topics
 # -------------------------------
-def extract_topics_from_questions(questions):
+def get_used_topics():
     """
-    Extract short topic labels from a list of questions.
+    Sorted list of all previously used topics, maintained in session state.
     """
-    prompt = f"""
-Extract a concise topic label (2–5 words) for each of the following oral board questions.
-Return ONLY a JSON list of UNIQUE topic strings.
+    return sorted(st.session_state.get("used_topics_set", set()))
 
-QUESTIONS:
-{json.dumps([q["question"] for q in questions], indent=2)}
-"""
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0
+# -------------------------------
+# SOURCE TEXT WINDOWING
+# -------------------------------
+_HEADING_RE = re.compile(r"^#|^[A-Z][A-Z ]{6,}$")
+
+
+def _window_text(text, max_chars=60_000):
+    """
+    Trim the source text to a character budget for the generation prompt.
+    Headings are always kept; other blocks are spread evenly across the manual.
+    """
+    if len(text) <= max_chars:
+        return text
+
+    # Split into paragraphs, breaking up oversized ones line by line
+    blocks = []
+    for para in text.split("\n\n"):
+        chunk = ""
+        for line in para.strip().splitlines():
+            if chunk and len(chunk) + len(line) > 2_000:
+                blocks.append(chunk)
+                chunk = ""
+            chunk = f"{chunk}\n{line}" if chunk else line
+        if chunk:
+            blocks.append(chunk)
+
+    headings = [i for i, b in enumerate(blocks) if _HEADING_RE.match(b.split("\n", 1)[0])]
+    heading_set = set(headings)
+    body = [i for i in range(len(blocks)) if i not in heading_set]
+    # Golden-ratio ordering spreads the selection across the whole manual
+    body.sort(key=lambda i: (i * 0.6180339887) % 1)
+
+    selected, budget = set(), max_chars
+    for i in headings + body:
+        cost = len(blocks[i]) + 2
+        if cost <= budget:
+            selected.add(i)
+            budget -= cost
+
+    if not selected:
+        return text[:max_chars]
+
+    return "\n\n".join(blocks[i] for i in sorted(selected))
+
+
+def _dedupe_against(text, reference, min_len=40):
+    """
+    Drop lines of text that repeat a line of reference verbatim, ignoring
+    surrounding whitespace (e.g. exemplar answers quoted in the manual).
+    Short lines are always kept, since they collide too easily.
+    """
+    def digest(line):
+        return hashlib.blake2b(line.encode(), digest_size=8).digest()
+
+    reference_digests = {
+        digest(line.strip()) for line in reference.splitlines() if len(line.strip()) >= min_len
+    }
+    return "\n".join(
+        line for line in text.splitlines()
+        if len(line.strip()) < min_len or digest(line.strip()) not in reference_digests
     )
-    raw = response.choices[0].message.content.strip()
-    raw = re.sub(r"```(?:json)?|```", "", raw).strip()
-    return json.loads(raw)
 
 
-def get_used_topics():
+def get_source_block():
     """
-    Aggregate all previously used topics from session state.
+    The SOURCE TEXT prompt block, materialized once per uploaded PDF
+    so repeat clicks reuse the same string (and the same cached prompt prefix).
+    Text already quoted in the prompt's examples is dropped first.
     """
-    used = set()
-    for s in st.session_state.get("all_question_sets", []):
-        for t in s.get("topics", []):
-            used.add(t)
-    return sorted(list(used))
+    pdf_hash = st.session_state.get("pdf_hash")
+    if st.session_state.get("source_block_hash") != pdf_hash:
+        source_text = _dedupe_against(st.session_state["pdf_text"], GENERATION_INSTRUCTIONS)
+        st.session_state["source_block"] = (
+            f"    SOURCE TEXT:\n    {_window_text(source_text)}\n"
+        )
+        st.session_state["source_block_hash"] = pdf_hash
+    return st.session_state["source_block"]
 
 # -------------------------------
 # QUESTION GENERATION (Single GPT Call, Previous Sets)
 # -------------------------------
-if uploaded_file:
-    st.subheader("🧩 Step 1: Generate Short-Answer Questions")
+GENERATION_CACHE_TTL = 3600  # seconds
 
-    num_questions = st.slider("Number of questions to generate:",1, 10, key="num_questions")
-    
-    if not pdf_text:
-        st.warning(
-            "⚠️ This PDF appears to be scanned or image-based. "
-            "Text extraction returned empty. OCR is required."
-    )
-    # Trigger generation if user clicks "Generate Questions" OR new set flag is set
-    if st.button("⚡ Generate Questions"):
-        if not pdf_text:
-            st.error(
-                "❌ Cannot generate questions because no text could be extracted.\n\n"
-                "This PDF is likely scanned. Please upload a text-based PDF "
-                "or enable OCR support."
-            )
-        else:
-            st.session_state["generate_now"] = True
-            st.session_state["question_set_id"] += 1
-            st.rerun()
-            
-    if st.session_state.get("generate_now"):
-        st.session_state["generate_now"] = False
-    
-        pdf_text = st.session_state["pdf_text"]
-        progress = st.progress(0, text="Generating questions... please wait")
 
+@st.cache_resource
+def _generation_cache():
+    """
+    Process-wide store of generated question sets: key -> (timestamp, items),
+    plus the lock guarding it, since every session thread shares the dict.
+    Keys are (pdf_hash, num_questions, used_topics, model, generation_nonce).
+    used_topics grows with every set a session generates, so repeat clicks in
+    one session always miss; hits come from other sessions (or reloads) that
+    reach the same point, most often the first set for a given PDF and count.
+    Bump generation_nonce to force a fresh set for otherwise identical inputs.
+    """
+    return {}, threading.Lock()
 
-        # -------------------------------
-        # 1️⃣ Prompt GPT to generate all questions
-        # -------------------------------
-        used_topics = get_used_topics()
-        prompt = f"""
+
+def get_cached_questions(key):
+    cache, lock = _generation_cache()
+    with lock:
+        entry = cache.get(key)
+    if entry and time.time() - entry[0] < GENERATION_CACHE_TTL:
+        return entry[1]
+    return None
+
+
+def store_cached_questions(key, items):
+    cache, lock = _generation_cache()
+    now = time.time()
+    with lock:
+        for expired in [k for k, (t, _) in cache.items() if now - t >= GENERATION_CACHE_TTL]:
+            del cache[expired]
+        cache[key] = (now, items)
+
+
+def _stream_json_items(chunks):
+    """
+    Yield each object of the first JSON array in a stream as soon as it completes.
+    Anything before the opening bracket (e.g. the {"questions": wrapper) is skipped.
+    The rest of the stream is still consumed after the array closes, so the
+    caller sees the final chunk (and its finish reason).
+    Raises ValueError if the stream ends before the array is closed.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    started = False
+    closed = False
+
+    for chunk in chunks:
+        if closed:
+            continue  # drain the trailing wrapper and finish chunk
+        buffer += chunk
+        if not started:
+            start = buffer.find("[")
+            if start == -1:
+                continue
+            buffer = buffer[start + 1:]
+            started = True
+        elif "}" not in chunk and "]" not in chunk:
+            continue  # no object or the array can have completed
+
+        while True:
+            buffer = buffer.lstrip(" \t\r\n,")
+            if buffer.startswith("]"):
+                closed = True
+                break
+            if not buffer:
+                break
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                break
+            buffer = buffer[end:]
+            yield item
+
+    if not closed:
+        raise ValueError("model output ended before the question list was complete")
+
+GENERATION_INSTRUCTIONS = """
     You are an expert medical educator.
-    Generate {num_questions} concise short-answer questions and their answer keys based on the following content.
-    PREVIOUSLY USED TOPICS (avoid these unless no alternatives remain): {json.dumps(used_topics, indent=2)}
+    Generate the requested number of concise short-answer questions and their answer keys based on the source text at the end of this prompt.
     Your target audience is residents and fellows.
     
     TASK:
     1. Identify ALL major topics in the source material.
-    2. Exclude any topics listed above.
-    3. Randomly select {num_questions} DIFFERENT remaining topics.
+    2. Exclude any PREVIOUSLY USED TOPICS listed at the end of this prompt.
+    3. Randomly select the requested number of DIFFERENT remaining topics.
     4. Write ONE concise short-answer question per topic, structured like a Royal College of Physicians and Surgeons oral boards exam.
     
     RULES:
@@ -227,23 +434,77 @@ if uploaded_file:
 
     
     Return ONLY JSON in this format:
-    [
-      {{"topic": "string", "question": "string", "answer_key": "string"}}
-    ]
+    {"questions": [
+      {"topic": "string", "question": "string", "answer_key": "string"}
+    ]}
     
-    SOURCE TEXT:
-    {pdf_text}
+"""
+
+
+@st.fragment
+def _run_generation(num_questions):
+    """
+    Generate a new question set, reporting progress in a status container.
+    """
+    with st.status("Generating questions... please wait", expanded=True) as status:
+        # -------------------------------
+        # 1️⃣ Prompt GPT to generate all questions
+        # -------------------------------
+        used_topics = get_used_topics()
+        prompt = "".join([
+            GENERATION_INSTRUCTIONS,
+            get_source_block(),
+            f"""
+    PREVIOUSLY USED TOPICS (avoid these unless no alternatives remain): {orjson.dumps(used_topics).decode()}
+
+    NUMBER OF QUESTIONS TO GENERATE: {num_questions}
     """
+        ])
         try:
-            response = client.chat.completions.create(
-                model="gpt-4.1-mini-2025-04-14",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.8
+            model = "gpt-4.1-mini-2025-04-14"
+            # Cross-session cache: used_topics changes after each set in this session
+            cache_key = (
+                st.session_state["pdf_hash"],
+                num_questions,
+                tuple(used_topics),
+                model,
+                st.session_state["generation_nonce"]
             )
-            raw = response.choices[0].message.content.strip()
-            raw = re.sub(r"```(?:json)?|```", "", raw).strip()
-            all_items = json.loads(raw)
-    
+            all_items = get_cached_questions(cache_key)
+            is_fresh = all_items is None
+
+            if is_fresh:
+                stream = _chat(
+                    model=model,
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=0.8,
+                    response_format=QUESTION_SET_FORMAT,
+                    stream=True
+                )
+                with stream:
+                    finish = {}
+
+                    def chunks():
+                        for chunk in stream:
+                            if not chunk.choices:
+                                continue
+                            choice = chunk.choices[0]
+                            if choice.finish_reason:
+                                finish["reason"] = choice.finish_reason
+                            yield choice.delta.content or ""
+
+                    all_items = []
+                    for item in _stream_json_items(chunks()):
+                        all_items.append(item)
+                        st.write(f"✅ {item.get('topic', '')}")
+                        status.update(
+                            label=f"Generated {len(all_items)}/{num_questions} questions...",
+                            state="running"
+                        )
+
+                if finish.get("reason") != "stop":
+                    raise ValueError(f"generation stopped early ({finish.get('reason', 'no finish reason')})")
+
             # Normalize structure
             all_questions = [
                 {
@@ -254,13 +515,16 @@ if uploaded_file:
                 for item in all_items
                 if item.get("question") and item.get("answer_key")
             ]
-            
-            progress.progress(50, text="Questions generated.")
-    
+
+            # Only complete, non-empty sets are worth serving again
+            if is_fresh and all_questions:
+                store_cached_questions(cache_key, all_items)
+
         except Exception as e:
             st.error(f"⚠️ Question generation failed: {e}")
-            all_questions = []
-    
+            status.update(label="⚠️ Question generation failed", state="error")
+            all_questions = None
+
         if all_questions:
             unilingual_questions = all_questions
 
@@ -269,28 +533,127 @@ if uploaded_file:
             # -------------------------------
             st.session_state["questions"] = unilingual_questions
             st.session_state["user_answers"] = [""] * len(unilingual_questions)
-            progress.progress(100, text="✅ Done! Questions ready!")
-    
+            status.update(label="✅ Done! Questions ready!", state="complete", expanded=False)
+
             # -------------------------------
             #  Store previous sets
             # -------------------------------
             if "all_question_sets" not in st.session_state:
                 st.session_state["all_question_sets"] = []
-    
+
             topics = [q.get("topic", "") for q in all_questions if q.get("topic")]
-            
+
             all_sets = st.session_state.get("all_question_sets", [])
             new_set_id = len(all_sets)  # unique incremental id
-            
+
             st.session_state["all_question_sets"].append({
                 "set_id": new_set_id,
                 "questions": unilingual_questions,
                 "topics": topics,
                 "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
             })
+            st.session_state["used_topics_set"].update(topics)
 
             st.session_state["current_set_id"] = new_set_id
             st.success(f"Generated {len(unilingual_questions)} representative questions successfully!")
+        elif all_questions is not None:
+            st.error("⚠️ Question generation returned no usable questions. Please try again.")
+            status.update(label="⚠️ Question generation failed", state="error")
+
+if uploaded_file:
+    st.subheader("🧩 Step 1: Generate Short-Answer Questions")
+
+    num_questions = st.slider("Number of questions to generate:",1, 10, key="num_questions")
+    
+    if not pdf_text:
+        st.warning(
+            "⚠️ This PDF appears to be scanned or image-based. "
+            "Text extraction returned empty. OCR is required."
+    )
+    # Trigger generation if user clicks "Generate Questions" OR new set flag is set
+    if st.button("⚡ Generate Questions"):
+        if not pdf_text:
+            st.error(
+                "❌ Cannot generate questions because no text could be extracted.\n\n"
+                "This PDF is likely scanned. Please upload a text-based PDF "
+                "or enable OCR support."
+            )
+        else:
+            st.session_state["generate_now"] = True
+            st.session_state["question_set_id"] += 1
+            st.rerun()
+            
+    if st.session_state.get("generate_now"):
+        st.session_state["generate_now"] = False
+        _run_generation(num_questions)
+
+# -------------------------------
+# AUDIO TRANSCRIPTION (Concurrent Whisper Calls)
+# -------------------------------
+@st.cache_data(ttl=24 * 3600, max_entries=256, show_spinner=False)
+def _whisper_cached(audio_hash, _audio_bytes):
+    """
+    Whisper transcription cached on the SHA-256 of the recording,
+    so the same clip is never paid for twice across reruns or sessions.
+    """
+    transcription = _whisper(_audio_bytes)
+
+    return getattr(transcription, "text", "").strip()
+
+
+async def transcribe_all(clips):
+    """
+    Transcribe a batch of (audio_hash, audio_bytes) recordings concurrently.
+    Returns one entry per clip: the transcript text, or the exception raised.
+    """
+    semaphore = asyncio.Semaphore(8)
+
+    async def transcribe(audio_hash, audio_bytes):
+        async with semaphore:
+            return await asyncio.to_thread(_whisper_cached, audio_hash, audio_bytes)
+
+    return await asyncio.gather(
+        *(transcribe(audio_hash, audio_bytes) for audio_hash, audio_bytes in clips),
+        return_exceptions=True
+    )
+
+
+def transcribe_pending(qid, num_questions):
+    """
+    Form submit callback: transcribe all new recordings in one batch and
+    append each transcript to its question's answer. Runs before the answer
+    text areas are created, so their key-backed state can be updated.
+    """
+    pending = []
+    for i in range(num_questions):
+        audio_data = st.session_state.get(f"audio_input_{qid}_{i}")
+        if audio_data is None:
+            continue
+
+        audio_bytes = audio_data.getvalue()
+        audio_hash = hashlib.sha256(audio_bytes).hexdigest()
+        last_hash_key = f"last_audio_hash_{i}"
+        if st.session_state.get(last_hash_key) != audio_hash:
+            pending.append((i, f"ans_{qid}_{i}", last_hash_key, audio_bytes, audio_hash))
+
+    if not pending:
+        return
+
+    results = asyncio.run(transcribe_all([
+        (audio_hash, audio_bytes) for _, _, _, audio_bytes, audio_hash in pending
+    ]))
+    notices = st.session_state["transcription_notices"]
+
+    for (i, answer_key, last_hash_key, _, audio_hash), result in zip(pending, results):
+        if isinstance(result, Exception):
+            notices[i] = ("error", f"⚠️ Audio transcription failed: {result}")
+        elif result:
+            existing_text = st.session_state.get(answer_key, "").strip()
+            st.session_state[answer_key] = f"{existing_text} {result}" if existing_text else result
+            st.session_state[last_hash_key] = audio_hash
+            notices[i] = ("success", "🎧 Dictation appended to your answer.")
+        else:
+            notices[i] = ("warning", "⚠️ Transcription returned empty text.")
 
 # -------------------------------
 # USER ANSWERS (WITH AUDIO INPUT)
@@ -303,91 +666,53 @@ if st.session_state["questions"]:
     if "user_answers" not in st.session_state or len(st.session_state["user_answers"]) != len(questions):
         st.session_state["user_answers"] = [""] * len(questions)
 
-    for i, q in enumerate(questions):
-        st.markdown(f"### Q{i+1}. {q.get('question', '')}")
+    qid = st.session_state["question_set_id"]
 
-        st.markdown("🎤 Dictate your answer (you can record multiple times):")
-        qid = st.session_state["question_set_id"]
-        answer_key = f"ans_{qid}_{i}"
-        buffer_key = f"dictation_buffer_{qid}_{i}"
-            
-        if buffer_key not in st.session_state:
-            st.session_state[buffer_key] = ""
-                
-        audio_data = st.audio_input(
-            "",
-            key=f"audio_input_{qid}_{i}"
-        )
+    # Batch all answer widgets so typing and recording don't rerun the script
+    with st.form("answers", clear_on_submit=False):
+        for i, q in enumerate(questions):
+            st.markdown(f"### Q{i+1}. {q.get('question', '')}")
 
-        transcriptions_key = f"transcriptions_{i}"
-        last_hash_key = f"last_audio_hash_{i}"
-        if transcriptions_key not in st.session_state:
-            st.session_state[transcriptions_key] = []
-        if last_hash_key not in st.session_state:
-            st.session_state[last_hash_key] = None
+            st.markdown("🎤 Dictate your answer (you can record multiple times):")
+            answer_key = f"ans_{qid}_{i}"
+
+            st.audio_input(
+                "",
+                key=f"audio_input_{qid}_{i}"
+            )
+
+            notice = st.session_state["transcription_notices"].pop(i, None)
+            if notice:
+                level, message = notice
+                getattr(st, level)(message)
+
+            current_text = st.text_area(
+                "✏️ Your Answer:",
+                height=80,
+                key=answer_key,
+                ).strip()
+
+            st.session_state["user_answers"][i] = current_text
 
-        dictated_text = ""
-        
-        if audio_data is not None:
-            try:
-                audio_bytes = audio_data.getvalue()
-                audio_hash = hashlib.sha256(audio_bytes).hexdigest()
-        
-                if st.session_state.get(last_hash_key) == audio_hash:
-                    st.info("This recording was already transcribed.", icon="ℹ️")
-                else:
-                    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp_file:
-                        tmp_file.write(audio_bytes)
-                        tmp_path = tmp_file.name
-        
-                    with open(tmp_path, "rb") as f:
-                        transcription = client.audio.transcriptions.create(
-                            model="whisper-1",
-                            file=f
-                        )
-        
-                    os.remove(tmp_path)
-        
-                    dictated_text = getattr(transcription, "text", "").strip()
-        
-                    if dictated_text:
-                        st.session_state[buffer_key] += (
-                            " " + dictated_text if st.session_state[buffer_key] else dictated_text
-                        )
-                        st.session_state[last_hash_key] = audio_hash
-                        st.success("🎧 Dictation appended to your answer.", icon="🎤")
-                    else:
-                        st.warning("⚠️ Transcription returned empty text.")
-        
-            except Exception as e:
-                st.error(f"⚠️ Audio transcription failed: {e}")
-
-        if st.session_state[buffer_key]:
-            st.session_state[answer_key] = (
-                st.session_state.get(answer_key, "") +
-                (" " if st.session_state.get(answer_key) else "") +
-                st.session_state[buffer_key]
-            ).strip()
-            st.session_state[buffer_key] = ""
-        
-        current_text = st.text_area(
-            "✏️ Your Answer:",
-            height=80,
-            key=answer_key,
-            ).strip()
-
-        # Clear buffer once applied
-        st.session_state[buffer_key] = ""
-        
-        st.session_state["user_answers"][i] = current_text
-    
         user_answers = st.session_state.get("user_answers", [])
 
+        # Both buttons transcribe new recordings first, so dictation is never lost
+        st.form_submit_button(
+            "📝 Transcribe Recordings",
+            on_click=transcribe_pending,
+            args=(qid, len(questions))
+        )
+        evaluate_submitted = st.form_submit_button(
+            "🚀 Evaluate My Answers",
+            on_click=transcribe_pending,
+            args=(qid, len(questions))
+        )
+
     # -------------------------------
     # EVALUATION
     # -------------------------------
-    def score_short_answers(user_answers, questions):
-        grading_prompt = f"""
+    def build_grading_prompt(user_answers, questions):
+        return f"""
         You are a supportive Royal College oral boards examiner assessing RESIDENT-LEVEL answers.
         
         Your goal is to fairly assess clinical understanding, not to fail candidates.
@@ -413,41 +738,80 @@ if st.session_state["questions"]:
         3. If the core idea is present, award at least 6/10
         4. Be especially fair to concise answers typical of oral exams
         
-        Return ONLY JSON:
-        [
+        Return ONLY JSON, one result per question, in the same order:
+        {{"results": [
           {{
             "score": 0,
             "feedback": "Brief, constructive feedback explaining the score.",
             "model_answer": "A concise ideal resident-level answer."
           }}
-        ]
+        ]}}
         
         QUESTIONS AND RESPONSES:
-        {json.dumps([
+        {orjson.dumps([
             {
                 "question": q.get("question", ""),
                 "expected": q.get("answer_key", ""),
                 "response": a
             }
             for q, a in zip(questions, user_answers)
-        ], indent=2)}
+        ]).decode()}
         """
+
+    async def _score_batch(async_client, semaphore, user_answers, questions):
+        async with semaphore:
+            response = await _achat(
+                async_client,
+                model="gpt-4o-mini",
+                messages=[{"role": "user", "content": build_grading_prompt(user_answers, questions)}],
+                temperature=0,
+                response_format=GRADING_FORMAT
+            )
+        results = orjson.loads(response.choices[0].message.content)["results"]
+
+        # A misaligned batch would score the wrong questions, so fail instead
+        if len(results) != len(questions):
+            raise ValueError(f"grader returned {len(results)} results for {len(questions)} questions")
+        return results
+
+    async def _score_all(user_answers, questions, batch_size=4):
+        """
+        Grade answers in mini-batches concurrently, preserving question order.
+        """
+        semaphore = asyncio.Semaphore(5)
+
+        async with AsyncOpenAI(max_retries=0) as async_client:
+            batches = await asyncio.gather(*(
+                _score_batch(
+                    async_client,
+                    semaphore,
+                    user_answers[i:i + batch_size],
+                    questions[i:i + batch_size]
+                )
+                for i in range(0, len(questions), batch_size)
+            ))
+
+        return [r for batch in batches for r in batch]
+
+    def score_short_answers(user_answers, questions):
         try:
-            response = client.chat.completions.create(
+            if len(questions) > 4:
+                return asyncio.run(_score_all(user_answers, questions))
+
+            response = _chat(
                 model="gpt-4o-mini",
-                messages=[{"role": "user", "content": grading_prompt}],
-                temperature=0
+                messages=[{"role": "user", "content": build_grading_prompt(user_answers, questions)}],
+                temperature=0,
+                response_format=GRADING_FORMAT
             )
-            raw = response.choices[0].message.content.strip()
-            raw = re.sub(r"```(?:json)?|```", "", raw).strip()
-            results = json.loads(raw)
+            results = orjson.loads(response.choices[0].message.content)["results"]
     
             return results
         except Exception as e:
             st.error(f"⚠️ Scoring failed: {e}")
             return []
 
-    if st.button("🚀 Evaluate My Answers"):
+    if evaluate_submitted:
         with st.spinner("Evaluating your answers..."):
             results = score_short_answers(user_answers, questions)
             st.session_state['evaluations'] = results
@@ -491,6 +855,7 @@ if st.session_state["questions"]:
         st.session_state["mode"] = "generate"
         st.session_state["generate_now"] = True
         st.session_state["question_set_id"] += 1
+        st.session_state["generation_nonce"] += 1
         st.rerun()
     
     url_feedback = "https://forms.gle/8cvfGhwNsd7fNAsd6"